@@ -1,9 +1,13 @@
 import ast
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 from hashlib import sha512
 import os
 import re
+import threading
+import time
 import traceback
+from urllib.parse import urlparse
 
 from flask import Flask, jsonify, request
 
@@ -11,6 +15,7 @@ import requests
 
 CACHE_FILE = '/tmp/cache.txt'
 CACHE_EXPIRY = timedelta(days=1)
+CACHE_STALE_WHILE_REVALIDATE = timedelta(seconds=int(os.environ.get('CACHE_STALE_WHILE_REVALIDATE', 3600)))
 
 DATE_FORMAT = '%d-%m-%Y %H:%M:%S'
 
@@ -21,6 +26,34 @@ LOG_LEVEL = os.environ.get('LOG_LEVEL', ERROR_LOG_LEVEL)
 
 SEPARATOR = '#@#'
 
+MIN_RATE_LIMIT_PER_SECOND = 0.01
+MIN_RATE_LIMIT_BURST = 1
+
+DEFAULT_RATE_LIMIT = {
+    'rate': max(float(os.environ.get('RATE_LIMIT_PER_SECOND', 2)), MIN_RATE_LIMIT_PER_SECOND),
+    'burst': max(int(os.environ.get('RATE_LIMIT_BURST', 4)), MIN_RATE_LIMIT_BURST)
+}
+
+HOSTS_RATE_LIMIT = {
+    'cvmweb.cvm.gov.br': {
+        'rate': max(float(os.environ.get('CVM_RATE_LIMIT_PER_SECOND', DEFAULT_RATE_LIMIT['rate'])), MIN_RATE_LIMIT_PER_SECOND),
+        'burst': max(int(os.environ.get('CVM_RATE_LIMIT_BURST', DEFAULT_RATE_LIMIT['burst'])), MIN_RATE_LIMIT_BURST)
+    },
+    'fundamentus.com.br': {
+        'rate': max(float(os.environ.get('FUNDAMENTUS_RATE_LIMIT_PER_SECOND', 1)), MIN_RATE_LIMIT_PER_SECOND),
+        'burst': max(int(os.environ.get('FUNDAMENTUS_RATE_LIMIT_BURST', 2)), MIN_RATE_LIMIT_BURST)
+    },
+    'investidor10.com.br': {
+        'rate': max(float(os.environ.get('INVESTIDOR10_RATE_LIMIT_PER_SECOND', 1)), MIN_RATE_LIMIT_PER_SECOND),
+        'burst': max(int(os.environ.get('INVESTIDOR10_RATE_LIMIT_BURST', 3)), MIN_RATE_LIMIT_BURST)
+    }
+}
+
+RATE_LIMIT_MAX_RETRIES = max(int(os.environ.get('RATE_LIMIT_MAX_RETRIES', 3)), 0)
+RATE_LIMIT_MAX_WAIT = max(float(os.environ.get('RATE_LIMIT_MAX_WAIT', 5)), 0)
+RATE_LIMIT_TIMEOUT = max(float(os.environ.get('RATE_LIMIT_TIMEOUT', 10)), 0)
+RATE_LIMITED_STATUS_CODES = { 429, 503 }
+
 VALID_SOURCES = {
     'ALL_SOURCE': 'all',
     'CVM_SOURCE': 'cvm',
@@ -66,6 +99,9 @@ VALID_INFOS = [
 
 investidor_10_preloaded_data = (None, None)
 
+hosts_bucket = {}
+hosts_bucket_condition = threading.Condition()
+
 app = Flask(__name__)
 app.json.sort_keys = False
 
@@ -91,6 +127,7 @@ def cache_exists():
 def upsert_cache(id, data):
     lines = []
     updated = False
+    cached_date = datetime.now().replace(microsecond=0)
 
     if cache_exists():
         with open(CACHE_FILE, 'r') as cache_file:
@@ -98,7 +135,7 @@ def upsert_cache(id, data):
 
     with open(CACHE_FILE, 'w') as cache_file:
         for line in lines:
-            if not line.startswith(id):
+            if not line.startswith(f'{id}{SEPARATOR}'):
                 cache_file.write(line)
                 continue
 
@@ -106,18 +143,21 @@ def upsert_cache(id, data):
             old_data = ast.literal_eval(old_data_as_text)
 
             combined_data = { **old_data, **data }
+            cached_date = datetime.strptime(old_cached_date_as_text, DATE_FORMAT)
             updated_line = f'{id}{SEPARATOR}{old_cached_date_as_text}{SEPARATOR}{combined_data}\n'
             cache_file.write(updated_line)
             updated = True
 
         if not updated:
-            new_line = f'{id}{SEPARATOR}{datetime.now().strftime(DATE_FORMAT)}{SEPARATOR}{data}\n'
+            new_line = f'{id}{SEPARATOR}{cached_date.strftime(DATE_FORMAT)}{SEPARATOR}{data}\n'
             cache_file.write(new_line)
             log_info(f'New cache entry created for "{id}"')
 
     if updated:
         log_info(f'Cache updated for "{id}"')
 
+    return cached_date
+
 def clear_cache(id):
     if not cache_exists():
         return
@@ -128,13 +168,13 @@ def clear_cache(id):
         lines = cache_file.readlines()
 
     with open(CACHE_FILE, 'w') as cache_file:
-        cache_file.writelines(line for line in lines if not line.startswith(id))
+        cache_file.writelines(line for line in lines if not line.startswith(f'{id}{SEPARATOR}'))
 
     log_info(f'Cache cleaning completed for "{id}"')
 
 def read_cache(id):
     if not cache_exists():
-        return None
+        return None, None
 
     log_debug('Reading cache')
 
@@ -142,7 +182,7 @@ def read_cache(id):
 
     with open(CACHE_FILE, 'r') as cache_file:
         for line in cache_file:
-            if not line.startswith(id):
+            if not line.startswith(f'{id}{SEPARATOR}'):
                 continue
 
             _, cached_date_as_text, data = line.strip().split(SEPARATOR)
@@ -150,7 +190,7 @@ def read_cache(id):
 
             if datetime.now() - cached_date <= CACHE_EXPIRY:
                 log_debug(f'Cache hit for "{id}" (Date: {cached_date_as_text})')
-                return ast.literal_eval(data)
+                return cached_date, ast.literal_eval(data)
 
             log_debug(f'Cache expired for "{id}" (Date: {cached_date_as_text})')
             clear_cache_control = True
@@ -160,7 +200,7 @@ def read_cache(id):
         clear_cache(id)
 
     log_info(f'No cache entry found for "{id}"')
-    return None
+    return None, None
 
 def delete_cache():
     if not cache_exists():
@@ -228,8 +268,154 @@ def text_to_number(text, should_convert_thousand_decimal_separators=True, conver
     except:
         return 0
 
+def get_host(url):
+    host = urlparse(url).hostname or ''
+    return host.removeprefix('www.')
+
+def get_host_bucket(host):
+    if host not in hosts_bucket:
+        rate_limit = HOSTS_RATE_LIMIT.get(host, DEFAULT_RATE_LIMIT)
+        hosts_bucket[host] = {
+            'rate': rate_limit['rate'],
+            'max_rate': rate_limit['rate'],
+            'burst': rate_limit['burst'],
+            'tokens': float(rate_limit['burst']),
+            'updated_at': time.monotonic(),
+            'blocked_until': 0,
+            'next_ticket': 0,
+            'serving_ticket': 0,
+            'abandoned_tickets': set()
+        }
+
+    return hosts_bucket[host]
+
+def refill_host_bucket(bucket):
+    now = time.monotonic()
+
+    bucket['tokens'] = min(bucket['burst'], bucket['tokens'] + (now - bucket['updated_at']) * bucket['rate'])
+    bucket['updated_at'] = now
+
+    if now < bucket['blocked_until']:
+        return bucket['blocked_until'] - now
+
+    if bucket['tokens'] >= 1:
+        return 0
+
+    return (1 - bucket['tokens']) / bucket['rate']
+
+def release_host_ticket(bucket, ticket):
+    if ticket != bucket['serving_ticket']:
+        bucket['abandoned_tickets'].add(ticket)
+        return
+
+    bucket['serving_ticket'] += 1
+
+    while bucket['serving_ticket'] in bucket['abandoned_tickets']:
+        bucket['abandoned_tickets'].remove(bucket['serving_ticket'])
+        bucket['serving_ticket'] += 1
+
+    hosts_bucket_condition.notify_all()
+
+def acquire_host_token(host, deadline):
+    with hosts_bucket_condition:
+        bucket = get_host_bucket(host)
+
+        ticket = bucket['next_ticket']
+        bucket['next_ticket'] += 1
+
+        try:
+            while True:
+                remaining_time = deadline - time.monotonic()
+                wait_time = remaining_time
+
+                if ticket == bucket['serving_ticket']:
+                    wait_time = refill_host_bucket(bucket)
+
+                    if wait_time <= 0:
+                        bucket['tokens'] -= 1
+                        return True
+
+                    if wait_time > RATE_LIMIT_MAX_WAIT:
+                        log_info(f'Rate limit wait for "{host}" ({wait_time:.2f}s) exceeds the maximum wait')
+                        return False
+
+                    log_debug(f'Rate limit reached for "{host}", waiting {wait_time:.2f}s')
+
+                if remaining_time <= 0 or wait_time > remaining_time:
+                    log_info(f'Rate limit wait budget exhausted for "{host}"')
+                    return False
+
+                hosts_bucket_condition.wait(wait_time)
+        finally:
+            release_host_ticket(bucket, ticket)
+
+def get_retry_after(response):
+    retry_after = response.headers.get('Retry-After')
+
+    if not retry_after:
+        return None
+
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+
+    try:
+        retry_date = parsedate_to_datetime(retry_after)
+        return (retry_date - datetime.now(retry_date.tzinfo)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+def slow_down_host(host, retry_after):
+    with hosts_bucket_condition:
+        bucket = get_host_bucket(host)
+        now = time.monotonic()
+
+        if now >= bucket['blocked_until']:
+            bucket['rate'] = max(bucket['rate'] / 2, bucket['max_rate'] / 16)
+
+        backoff = max(retry_after if retry_after is not None else 1 / bucket['rate'], 0)
+
+        bucket['tokens'] = 0
+        bucket['blocked_until'] = max(bucket['blocked_until'], now + backoff)
+
+        hosts_bucket_condition.notify_all()
+
+        log_info(f'Rate limited by "{host}", backing off {backoff:.2f}s and lowering rate to {bucket["rate"]:.2f} req/s')
+
+        return bucket['blocked_until'] - now
+
+def speed_up_host(host):
+    with hosts_bucket_condition:
+        bucket = get_host_bucket(host)
+        bucket['rate'] = min(bucket['max_rate'], bucket['rate'] + bucket['max_rate'] / 10)
+
 def request_get(url, headers=None):
-    response = requests.get(url, headers=headers)
+    host = get_host(url)
+    deadline = time.monotonic() + RATE_LIMIT_TIMEOUT
+    response = None
+
+    for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+        if not acquire_host_token(host, deadline):
+            break
+
+        response = requests.get(url, headers=headers, timeout=max(deadline - time.monotonic(), 1))
+
+        if response.status_code not in RATE_LIMITED_STATUS_CODES:
+            if 200 <= response.status_code < 400:
+                speed_up_host(host)
+            break
+
+        log_debug(f'Response from {url} : {response} (Attempt {attempt + 1})')
+        blocked_time = slow_down_host(host, get_retry_after(response))
+
+        if blocked_time > RATE_LIMIT_MAX_WAIT or time.monotonic() + blocked_time > deadline:
+            log_info(f'Giving up on {url}, "{host}" is blocked for {blocked_time:.2f}s')
+            break
+
+    if response is None:
+        raise requests.exceptions.Timeout(f'Rate limit wait budget exhausted before requesting {url}')
+
     response.raise_for_status()
 
     log_debug(f'Response from {url} : {response}')
@@ -606,40 +792,40 @@ def get_data_from_sources(ticker, source, info_names):
 
 def get_data_from_cache(ticker, info_names, can_use_cache):
     if not can_use_cache:
-        return None
+        return None, None
 
-    cached_data = read_cache(ticker)
+    cached_date, cached_data = read_cache(ticker)
     if not cached_data:
-        return None
+        return None, None
 
     filtered_data = { key: cached_data[key] for key in info_names if key in cached_data }
     log_info(f'Data from Cache: {filtered_data}')
 
-    return filtered_data
+    return cached_date, filtered_data
 
 def get_data(ticker, source, info_names, can_use_cache):
-    cached_data = get_data_from_cache(ticker, info_names, can_use_cache)
+    cached_date, cached_data = get_data_from_cache(ticker, info_names, can_use_cache)
 
     SHOULD_UPDATE_CACHE = True
 
     if not can_use_cache:
-        return not SHOULD_UPDATE_CACHE, get_data_from_sources(ticker, source, info_names)
+        return not SHOULD_UPDATE_CACHE, None, get_data_from_sources(ticker, source, info_names)
 
     missing_cache_info_names = filter_remaining_infos(cached_data, info_names)
 
     if not missing_cache_info_names:
-        return not SHOULD_UPDATE_CACHE, cached_data
+        return not SHOULD_UPDATE_CACHE, cached_date, cached_data
 
     source_data = get_data_from_sources(ticker, source, missing_cache_info_names)
 
     if cached_data and source_data:
-        return SHOULD_UPDATE_CACHE, { **cached_data, **source_data }
+        return SHOULD_UPDATE_CACHE, cached_date, { **cached_data, **source_data }
     elif cached_data and not source_data:
-        return not SHOULD_UPDATE_CACHE, cached_data
+        return not SHOULD_UPDATE_CACHE, cached_date, cached_data
     elif not cached_data and source_data:
-        return SHOULD_UPDATE_CACHE, source_data
+        return SHOULD_UPDATE_CACHE, cached_date, source_data
 
-    return not SHOULD_UPDATE_CACHE, None
+    return not SHOULD_UPDATE_CACHE, None, None
 
 def get_parameter_info(params, name, default=None):
     return params.get(name, default).replace(' ', '').lower()
@@ -647,6 +833,21 @@ def get_parameter_info(params, name, default=None):
 def get_cache_parameter_info(params, name, default='0'):
     return get_parameter_info(params, name, default) in { '1', 's', 'sim', 't', 'true', 'y', 'yes' }
 
+def add_cache_headers(response, ticker, data, info_names, cached_date):
+    # Only If-None-Match is supported: upsert_cache keeps the entry creation date when merging new data, so it can not be used as Last-Modified
+    response.set_etag(sha512(f'{ticker}{SEPARATOR}{data}'.encode()).hexdigest()[:32])
+
+    if filter_remaining_infos(data, info_names):
+        response.headers['Cache-Control'] = 'no-cache'
+    else:
+        cache_age = datetime.now() - cached_date
+        max_age = max(int((CACHE_EXPIRY - cache_age).total_seconds()), 0)
+        stale_while_revalidate = int(CACHE_STALE_WHILE_REVALIDATE.total_seconds())
+
+        response.headers['Cache-Control'] = f'public, max-age={max_age}, s-maxage={max_age}, stale-while-revalidate={stale_while_revalidate}'
+
+    log_debug(f'Cache headers for "{ticker}": ETag {response.get_etag()[0]} - Cache-Control {response.headers["Cache-Control"]}')
+
 @app.route('/acao/<ticker>', methods=['GET'])
 def get_acao_data(ticker):
     should_delete_all_cache = get_cache_parameter_info(request.args, 'should_delete_all_cache')
@@ -666,7 +867,7 @@ def get_acao_data(ticker):
 
     can_use_cache = preprocess_cache(ticker, should_delete_all_cache, should_clear_cached_data, should_use_cache)
 
-    should_update_cache, data = get_data(ticker, source, info_names, can_use_cache)
+    should_update_cache, cached_date, data = get_data(ticker, source, info_names, can_use_cache)
 
     log_debug(f'Final Data: {data}')
 
@@ -674,9 +875,14 @@ def get_acao_data(ticker):
         return jsonify({ 'error': 'No data found' }), 404
 
     if can_use_cache and should_update_cache:
-        upsert_cache(ticker, data)
+        cached_date = upsert_cache(ticker, data)
+
+    response = jsonify(data)
+
+    if can_use_cache and cached_date:
+        add_cache_headers(response, ticker, data, info_names, cached_date)
 
-    return jsonify(data), 200
+    return response.make_conditional(request)
 
 if __name__ == '__main__':
     log_debug('Starting acaoCrawler API')
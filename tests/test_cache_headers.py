@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+import re
+
+import pytest
+
+import index
+
+def get_max_age(response):
+    return int(re.search(r'max-age=(\d+)', response.headers['Cache-Control']).group(1))
+
+def write_cache_entry(ticker, cached_date, data):
+    with open(index.CACHE_FILE, 'w') as cache_file:
+        cache_file.write(f'{ticker}{index.SEPARATOR}{cached_date.strftime(index.DATE_FORMAT)}{index.SEPARATOR}{data}\n')
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(index, 'CACHE_FILE', str(tmp_path / 'cache.txt'))
+    monkeypatch.setattr(index, 'get_data_from_sources', lambda ticker, source, info_names: None)
+
+    return index.app.test_client()
+
+@pytest.mark.parametrize('age', [ timedelta(0), timedelta(hours=1), timedelta(hours=12) ])
+def test_max_age_shrinks_as_cache_entry_ages(client, age):
+    write_cache_entry('PETR4', datetime.now() - age, { 'price': 10 })
+
+    response = client.get('/acao/PETR4?info_names=price')
+
+    expected_max_age = (index.CACHE_EXPIRY - age).total_seconds()
+    assert response.status_code == 200
+    assert expected_max_age - 5 <= get_max_age(response) <= expected_max_age
+    assert response.headers['Cache-Control'].startswith('public')
+
+def test_max_age_is_zero_after_cache_expiry():
+    response = index.app.response_class()
+
+    index.add_cache_headers(response, 'PETR4', { 'price': 10 }, [ 'price' ], datetime.now() - index.CACHE_EXPIRY - timedelta(minutes=1))
+
+    assert get_max_age(response) == 0
+
+def test_new_cache_entry_gets_full_max_age(client, monkeypatch):
+    monkeypatch.setattr(index, 'get_data_from_sources', lambda ticker, source, info_names: { 'price': 10 })
+
+    response = client.get('/acao/PETR4?info_names=price')
+
+    assert get_max_age(response) >= index.CACHE_EXPIRY.total_seconds() - 5
+
+def test_incomplete_data_is_not_cached(client, monkeypatch):
+    monkeypatch.setattr(index, 'get_data_from_sources', lambda ticker, source, info_names: { 'price': 1.0, 'pl': None })
+
+    first_response = client.get('/acao/PETR4?info_names=price,pl')
+
+    monkeypatch.setattr(index, 'get_data_from_sources', lambda ticker, source, info_names: None)
+
+    second_response = client.get('/acao/PETR4?info_names=price,pl')
+
+    assert first_response.headers['Cache-Control'] == 'no-cache'
+    assert second_response.headers['Cache-Control'] == 'no-cache'
+    assert second_response.headers['ETag']
+
+def test_if_none_match_returns_not_modified(client):
+    write_cache_entry('PETR4', datetime.now(), { 'price': 10 })
+
+    etag = client.get('/acao/PETR4?info_names=price').headers['ETag']
+    response = client.get('/acao/PETR4?info_names=price', headers={ 'If-None-Match': etag })
+
+    assert response.status_code == 304
+    assert response.data == b''
+
+def test_if_modified_since_is_not_supported(client):
+    write_cache_entry('PETR4', datetime.now(), { 'price': 10 })
+
+    response = client.get('/acao/PETR4?info_names=price', headers={ 'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT' })
+
+    assert response.status_code == 200
+    assert 'Last-Modified' not in response.headers